@@ -0,0 +1,45 @@
+import numpy as np
+
+def percentile_bounds(img, low=2, high=98, bins=1024):
+    """
+    Estimate the low/high percentiles of an image from a histogram CDF
+
+    NaN and infinite values are ignored. Bounds are returned as floats so
+    integer data cannot overflow; an image with no finite values gives (0, 0).
+
+    Parameters:
+    -----------
+    img : ndarray
+        Band or image to stretch
+    low, high : float
+        Percentiles to estimate
+    bins : int
+        Number of histogram bins, which sets the precision of the estimate
+
+    Returns:
+    --------
+    tuple : (low, high) percentile estimates
+    """
+    vmin, vmax = float(img.min()), float(img.max())
+    if not (np.isfinite(vmin) and np.isfinite(vmax)):
+        img = img[np.isfinite(img)]
+        if img.size == 0:
+            return 0.0, 0.0
+        vmin, vmax = float(img.min()), float(img.max())
+    if vmax == vmin:
+        return vmin, vmax
+    hist, _ = np.histogram(img, bins=bins, range=(vmin, vmax))
+    cdf = np.cumsum(hist)
+    k_low, k_high = np.searchsorted(cdf, [low / 100 * cdf[-1], high / 100 * cdf[-1]])
+    scale = (vmax - vmin) / bins
+    return vmin + k_low * scale, vmin + k_high * scale
+
+def nearest_bands(wavelengths, targets):
+    """Return indices of the bands closest to each target in a sorted wavelength array"""
+    wavelengths = np.asarray(wavelengths)
+    targets = np.asarray(targets)
+    if len(wavelengths) < 2:
+        return np.zeros(len(targets), dtype=int)
+    idx = np.clip(np.searchsorted(wavelengths, targets), 1, len(wavelengths) - 1)
+    idx -= (targets - wavelengths[idx - 1]) <= (wavelengths[idx] - targets)
+    return idx
@@ -0,0 +1,77 @@
+import os
+import pickle
+from functools import lru_cache
+from spectral.io.envi import read_envi_header
+
+# Header fields converted to integers after parsing
+INT_FIELDS = ['samples', 'lines', 'bands', 'data type', 'header offset', 'byte order']
+
+def convert_values(header):
+    """
+    Convert parsed ENVI header strings to numeric types where possible
+
+    Parameters:
+    -----------
+    header : dict
+        Header as returned by spectral's read_envi_header
+
+    Returns:
+    --------
+    dict : Header with integer fields and numeric arrays converted
+    """
+    header_info = {}
+    for key, value in header.items():
+        key = key.lower()
+        if isinstance(value, list):
+            try:
+                value = [float(x) for x in value if str(x).strip()]
+            except ValueError:
+                value = [x.strip() for x in value if x.strip()]
+        elif key in INT_FIELDS:
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        header_info[key] = value
+    return header_info
+
+@lru_cache(maxsize=16)
+def _read_header_cached(header_file, mtime):
+    """Parse a header, reusing the pickled sidecar if it matches mtime"""
+    cache_file = header_file + '.pkl'
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['mtime'] == mtime:
+            return cached['header']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+        pass
+
+    header_info = convert_values(read_envi_header(header_file))
+
+    try:
+        with open(cache_file, 'wb') as f:
+            pickle.dump({'mtime': mtime, 'header': header_info}, f)
+    except OSError:
+        print(f"Warning: Could not write header cache {cache_file}")
+
+    return header_info
+
+def read_header(header_file):
+    """
+    Read ENVI header file and parse all metadata
+
+    Parsed headers are cached in memory and in a pickle sidecar next to the
+    header, keyed on the header modification time.
+
+    Parameters:
+    -----------
+    header_file : str
+        Path to header file
+
+    Returns:
+    --------
+    dict : Header information including wavelengths and metadata
+    """
+    mtime = os.path.getmtime(header_file)
+    return dict(_read_header_cached(os.path.abspath(header_file), mtime))
@@ -1,4 +1,5 @@
 import numpy as np
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button
 import tkinter as tk
@@ -6,82 +7,171 @@ from tkinter import ttk
 import matplotlib.backends.backend_tkagg as tkagg
 from matplotlib.figure import Figure
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from envi_header import read_header
+from display_utils import percentile_bounds
+
+# numpy types for ENVI data type codes
+ENVI_DTYPES = {
+    1: np.uint8,
+    2: np.int16,
+    3: np.int32,
+    4: np.float32,
+    5: np.float64,
+    12: np.uint16,
+}
 
 class HyperspectralViewer:
+    # Decimation step of the overview used while the full image is in view
+    OVERVIEW_STEP = 4
+    
+    # Number of decimated bands kept in memory
+    OVERVIEW_CACHE_SIZE = 32
+    
+    # Delay in ms after the last slider event before a full-resolution redraw
+    SLIDER_DELAY = 30
+    
     def __init__(self, data_file, header_file):
         """Initialize the hyperspectral data viewer"""
+        self._band_buf = None
+        self._rgb_buf = None
+        self._rgb_keys = [None, None, None]
+        self._band_im = None
+        self._rgb_im = None
+        self._band_key = None
+        self._pending = {}
         self.load_header(header_file)
         self.load_data(data_file)
         self.create_gui()
         
     def load_header(self, header_file):
         """Load and parse the ENVI header file"""
-        self.header = {}
-        with open(header_file, 'r') as f:
-            lines = f.readlines()
-            
-        current_key = None
-        current_value = []
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            if '=' in line:
-                if current_key:
-                    self.header[current_key] = self.process_value(current_value)
-                    current_value = []
-                
-                key, value = [x.strip() for x in line.split('=', 1)]
-                current_key = key.lower()
-                
-                if '{' in value and '}' in value:
-                    value = value.split('{')[1].split('}')[0].strip()
-                    self.header[current_key] = self.process_value([value])
-                    current_key = None
-                elif '{' in value:
-                    current_value.append(value.split('{')[1])
-                else:
-                    self.header[current_key] = self.process_value([value])
-                    current_key = None
-            elif current_key:
-                if '}' in line:
-                    current_value.append(line.split('}')[0])
-                    self.header[current_key] = self.process_value(current_value)
-                    current_key = None
-                else:
-                    current_value.append(line)
-                    
-    def process_value(self, value_list):
-        """Process header values, converting to appropriate types"""
-        value = ', '.join(value_list).strip()
-        
-        try:
-            if ',' in value:
-                return [float(x.strip()) for x in value.split(',') if x.strip()]
-            else:
-                return int(value)
-        except ValueError:
-            return value
+        self.header = read_header(header_file)
             
     def load_data(self, data_file):
         """Load hyperspectral data using memory mapping"""
         self.samples = self.header['samples']
         self.lines = self.header['lines']
         self.bands = self.header['bands']
-        
-        self.data = np.memmap(data_file, dtype=np.float32, mode='r',
-                            shape=(self.bands, self.lines, self.samples))
+        self.interleave = str(self.header.get('interleave', 'bsq')).lower()
+        
+        if self.interleave == 'bip':
+            shape = (self.lines, self.samples, self.bands)
+        elif self.interleave == 'bil':
+            shape = (self.lines, self.bands, self.samples)
+        else:
+            shape = (self.bands, self.lines, self.samples)
+        dtype = ENVI_DTYPES[self.header.get('data type', 4)]
+        self.data = np.memmap(data_file, dtype=dtype, mode='r', shape=shape)
+        self.scale = float(self.header.get('reflectance scale factor', 1))
+        
+        # Unsigned integer data is enhanced through lookup tables straight to
+        # 8-bit display values; float data is displayed as float32 in [0,1]
+        if dtype in (np.uint8, np.uint16):
+            self.display_dtype = np.uint8
+            self.display_max = 255
+        else:
+            self.display_dtype = np.float32
+            self.display_max = 1
+        self.overview = OrderedDict()
         
         self.wavelengths = self.header.get('wavelength', 
                                          np.arange(self.bands))
                                          
-    def enhance_image(self, img):
+    def get_band(self, band_index):
+        """Return a (lines, samples) view of a single band"""
+        if self.interleave == 'bip':
+            return self.data[:, :, band_index]
+        elif self.interleave == 'bil':
+            return self.data[:, band_index, :]
+        return self.data[band_index]
+        
+    def get_overview_band(self, band_index):
+        """Return a decimated copy of a single band, keeping recently used bands cached"""
+        band = self.overview.get(band_index)
+        if band is None:
+            step = self.OVERVIEW_STEP
+            band = self.get_band(band_index)[::step, ::step].copy()
+            self.overview[band_index] = band
+            if len(self.overview) > self.OVERVIEW_CACHE_SIZE:
+                self.overview.popitem(last=False)
+        else:
+            self.overview.move_to_end(band_index)
+        return band
+        
+    def get_view_window(self, ax):
+        """Return the (r0, r1, c0, c1) pixel window visible in ax"""
+        x0, x1 = sorted(ax.get_xlim())
+        y0, y1 = sorted(ax.get_ylim())
+        c0 = max(0, int(np.floor(x0 + 0.5)))
+        c1 = min(self.samples, int(np.ceil(x1 + 0.5)))
+        r0 = max(0, int(np.floor(y0 + 0.5)))
+        r1 = min(self.lines, int(np.ceil(y1 + 0.5)))
+        return r0, r1, c0, c1
+        
+    def get_display_band(self, ax, band_index, preview=False):
+        """
+        Return band data and image extent for display in ax, using the
+        overview unless the axes are zoomed in to part of the image
+        """
+        if ax.images and not preview:
+            r0, r1, c0, c1 = self.get_view_window(ax)
+            zoomed = c1 - c0 < self.samples or r1 - r0 < self.lines
+            if zoomed and c1 > c0 and r1 > r0:
+                return (self.get_band(band_index)[r0:r1, c0:c1],
+                        (c0 - 0.5, c1 - 0.5, r1 - 0.5, r0 - 0.5))
+                        
+        return (self.get_overview_band(band_index),
+                (-0.5, self.samples - 0.5, self.lines - 0.5, -0.5))
+        
+    def get_spectrum(self, x, y):
+        """Return the spectrum of a single pixel"""
+        if self.interleave == 'bip':
+            return self.data[y, x, :]
+        elif self.interleave == 'bil':
+            return self.data[y, :, x]
+        return self.data[:, y, x]
+        
+    def enhance_image(self, img, out=None):
         """Enhance image contrast using percentile normalization"""
-        p2, p98 = np.percentile(img, (2, 98))
-        img_enhanced = np.clip((img - p2) / (p98 - p2), 0, 1)
-        return img_enhanced
+        if out is None:
+            if self._band_buf is None or self._band_buf.shape != img.shape:
+                self._band_buf = np.empty(img.shape, dtype=self.display_dtype)
+            out = self._band_buf
+            
+        p2, p98 = percentile_bounds(img)
+        if p98 == p2:
+            out[...] = 0
+            return out
+            
+        if img.dtype in (np.uint8, np.uint16):
+            # Quantized data maps through a lookup table in a single pass
+            out_max = 255 if out.dtype == np.uint8 else 1
+            lut = np.arange(np.iinfo(img.dtype).max + 1, dtype=np.float32)
+            lut -= p2
+            lut *= out_max / (p98 - p2)
+            np.clip(lut, 0, out_max, out=lut)
+            np.take(lut.astype(out.dtype), img, out=out, mode='clip')
+            return out
+            
+        np.subtract(img, p2, out=out)
+        out /= (p98 - p2)
+        np.clip(out, 0, 1, out=out)
+        return out
+        
+    def enhance_rgb(self, r, g, b, out, enhance=True):
+        """
+        Write three channels into an (H, W, 3) display buffer, contrast
+        enhanced if requested. Channels passed as None are left untouched.
+        """
+        for i, channel in enumerate((r, g, b)):
+            if channel is None:
+                continue
+            if enhance:
+                self.enhance_image(channel, out=out[:, :, i])
+            else:
+                np.multiply(channel, self.display_max / self.scale, out=out[:, :, i],
+                            casting='unsafe')
+        return out
         
     def create_gui(self):
         """Create the main GUI window with visualization panels"""
@@ -117,7 +207,7 @@ class HyperspectralViewer:
         ttk.Label(self.slider_frame, text="Band:").pack(side=tk.LEFT)
         self.band_slider = ttk.Scale(self.slider_frame, from_=0, 
                                    to=self.bands-1, orient=tk.HORIZONTAL,
-                                   command=self.update_band_display)
+                                   command=self.on_band_slider)
         self.band_slider.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
         # Create RGB band selection
@@ -127,19 +217,19 @@ class HyperspectralViewer:
         ttk.Label(rgb_frame, text="R:").pack(side=tk.LEFT)
         self.r_slider = ttk.Scale(rgb_frame, from_=0, to=self.bands-1, 
                                 orient=tk.HORIZONTAL,
-                                command=lambda x: self.update_rgb_display())
+                                command=lambda x: self.on_rgb_slider())
         self.r_slider.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
         ttk.Label(rgb_frame, text="G:").pack(side=tk.LEFT)
         self.g_slider = ttk.Scale(rgb_frame, from_=0, to=self.bands-1, 
                                 orient=tk.HORIZONTAL,
-                                command=lambda x: self.update_rgb_display())
+                                command=lambda x: self.on_rgb_slider())
         self.g_slider.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
         ttk.Label(rgb_frame, text="B:").pack(side=tk.LEFT)
         self.b_slider = ttk.Scale(rgb_frame, from_=0, to=self.bands-1, 
                                 orient=tk.HORIZONTAL,
-                                command=lambda x: self.update_rgb_display())
+                                command=lambda x: self.on_rgb_slider())
         self.b_slider.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
         # Add enhancement controls
@@ -169,48 +259,109 @@ class HyperspectralViewer:
         # Connect mouse events
         self.fig.canvas.mpl_connect('button_press_event', self.on_click)
         
+        # Zoom, pan, toolbar navigation and keyboard shortcuts all change the
+        # axes limits, so redraw on limit changes rather than mouse events
+        for ax in (self.ax_band, self.ax_rgb):
+            ax.callbacks.connect('xlim_changed', self.on_limits_changed)
+            ax.callbacks.connect('ylim_changed', self.on_limits_changed)
+        
         self.fig.tight_layout()
         
-    def update_band_display(self, band_index):
+    def debounce(self, key, callback, *args):
+        """Run callback after SLIDER_DELAY ms, replacing any pending call for key"""
+        if key in self._pending:
+            self.root.after_cancel(self._pending.pop(key))
+            
+        def run():
+            self._pending.pop(key, None)
+            callback(*args)
+            
+        self._pending[key] = self.root.after(self.SLIDER_DELAY, run)
+        
+    def on_band_slider(self, band_index):
+        """Preview the band from the overview while dragging, then redraw once settled"""
+        self.update_band_display(band_index, preview=True)
+        self.debounce('band', self.update_band_display, band_index)
+        
+    def on_rgb_slider(self):
+        """Preview the composite from the overview while dragging, then redraw once settled"""
+        self.update_rgb_display(preview=True)
+        self.debounce('rgb', self.update_rgb_display)
+        
+    def update_band_display(self, band_index, preview=False):
         """Update the single band display"""
         band_index = int(band_index)
-        band_data = self.data[band_index].copy()
+        self.current_band = band_index
+        band_data, extent = self.get_display_band(self.ax_band, band_index, preview)
+        
+        # Nothing to do if this band was already drawn at this resolution
+        key = (band_index, self.enhance_var.get(), extent)
+        if key == self._band_key:
+            return
+        self._band_key = key
         
         if self.enhance_var.get():
             band_data = self.enhance_image(band_data)
+            vmin, vmax = 0, self.display_max
+        else:
+            vmin, vmax = band_data.min(), band_data.max()
         
-        self.ax_band.clear()
-        im = self.ax_band.imshow(band_data, cmap='gray')
+        if self._band_im is None:
+            self._band_im = self.ax_band.imshow(band_data, cmap='gray', extent=extent,
+                                                vmin=vmin, vmax=vmax)
+            
+            # Add colorbar
+            divider = make_axes_locatable(self.ax_band)
+            cax = divider.append_axes("right", size="5%", pad=0.05)
+            self._cbar = self.fig.colorbar(self._band_im, cax=cax)
+        else:
+            # Update the existing image rather than rebuilding it
+            self._band_im.set_data(band_data)
+            self._band_im.set_extent(extent)
+            self._band_im.set_clim(vmin, vmax)
+            
         self.ax_band.set_title(f'Band {band_index} '
                               f'({self.wavelengths[band_index]:.2f} nm)')
         
-        # Add colorbar
-        divider = make_axes_locatable(self.ax_band)
-        cax = divider.append_axes("right", size="5%", pad=0.05)
-        self.fig.colorbar(im, cax=cax)
-        
         self.fig.canvas.draw_idle()
         
-    def update_rgb_display(self):
+    def update_rgb_display(self, preview=False):
         """Update the RGB composite display"""
         try:
             r_idx = int(self.r_slider.get())
             g_idx = int(self.g_slider.get())
             b_idx = int(self.b_slider.get())
             
-            # Create RGB composite
-            rgb = np.dstack((
-                self.data[r_idx].copy(),
-                self.data[g_idx].copy(),
-                self.data[b_idx].copy()
-            ))
+            enhance = self.enhance_var.get()
+            channels = []
+            keys = []
+            for idx in (r_idx, g_idx, b_idx):
+                channel, extent = self.get_display_band(self.ax_rgb, idx, preview)
+                channels.append(channel)
+                keys.append((idx, enhance, extent))
             
-            # Apply enhancement if enabled
-            if self.enhance_var.get():
-                rgb = np.dstack([self.enhance_image(rgb[:,:,i]) for i in range(3)])
+            # Nothing to do if this composite was already drawn at this resolution
+            if keys == self._rgb_keys and self._rgb_im is not None:
+                return
+                
+            # Create RGB composite in a reused buffer
+            shape = channels[0].shape + (3,)
+            if self._rgb_buf is None or self._rgb_buf.shape != shape:
+                self._rgb_buf = np.empty(shape, dtype=self.display_dtype)
+                self._rgb_keys = [None, None, None]
+            
+            # Only refill channels whose band, enhancement or view changed
+            for i, key in enumerate(keys):
+                if key == self._rgb_keys[i]:
+                    channels[i] = None
+            rgb = self.enhance_rgb(*channels, out=self._rgb_buf, enhance=enhance)
+            self._rgb_keys = keys
             
-            self.ax_rgb.clear()
-            self.ax_rgb.imshow(rgb)
+            if self._rgb_im is None:
+                self._rgb_im = self.ax_rgb.imshow(rgb, extent=extent)
+            else:
+                self._rgb_im.set_data(rgb)
+                self._rgb_im.set_extent(extent)
             self.ax_rgb.set_title(f'RGB Composite (R:{r_idx}, G:{g_idx}, B:{b_idx})')
             self.fig.canvas.draw_idle()
             
@@ -225,9 +376,28 @@ class HyperspectralViewer:
                 if 0 <= x < self.samples and 0 <= y < self.lines:
                     self.plot_spectrum(x, y)
                     
+    def on_limits_changed(self, ax):
+        """Redraw once the view has settled after a zoom, pan or toolbar navigation"""
+        self.debounce('view', self.on_view_changed)
+        
+    def view_is_stale(self, ax):
+        """Return True if the image drawn in ax does not cover the visible window"""
+        if not ax.images:
+            return False
+        left, right, bottom, top = ax.images[0].get_extent()
+        drawn = (int(top + 0.5), int(bottom + 0.5), int(left + 0.5), int(right + 0.5))
+        return drawn != self.get_view_window(ax)
+        
+    def on_view_changed(self):
+        """Redraw images at the resolution matching the current view"""
+        if self.view_is_stale(self.ax_band):
+            self.update_band_display(self.current_band)
+        if self.view_is_stale(self.ax_rgb):
+            self.update_rgb_display()
+                
     def plot_spectrum(self, x, y):
         """Plot spectrum for selected pixel"""
-        spectrum = self.data[:, y, x]
+        spectrum = self.get_spectrum(x, y) / self.scale
         
         self.ax_spectrum.clear()
         self.ax_spectrum.plot(self.wavelengths, spectrum)
@@ -244,8 +414,8 @@ class HyperspectralViewer:
 
 if __name__ == '__main__':
     # File paths
-    data_file = 'afx102_1_2026_radcorr.dat'
-    header_file = 'afx102_1_2026_radcorr.dat.hdr'
+    data_file = 'afx102_1_2026_radcorr_bip.dat'
+    header_file = 'afx102_1_2026_radcorr_bip.dat.hdr'
     
     try:
         viewer = HyperspectralViewer(data_file, header_file)
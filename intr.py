@@ -1,11 +1,7 @@
 import numpy as np
-import rasterio
 import matplotlib.pyplot as plt
-import matplotlib as mpl
 from spectral.io import envi
-from spectral import view_cube
-import spectral
-default_dpi = mpl.rcParamsDefault['figure.dpi']
+from display_utils import percentile_bounds, nearest_bands
 
 def read_hyperspectral_data(radiance_file, header_file):
     """
@@ -28,17 +24,19 @@ def read_hyperspectral_data(radiance_file, header_file):
             rgb_bands = [int(b) for b in header['default bands']]
         else:
             # Approximate bands for RGB (around 650nm, 550nm, 450nm)
-            rgb_bands = [
-                np.argmin(np.abs(wavelengths - 650)),
-                np.argmin(np.abs(wavelengths - 550)),
-                np.argmin(np.abs(wavelengths - 450))
-            ]
+            rgb_bands = nearest_bands(wavelengths, [650, 550, 450])
         
         # Create RGB image
-        rgb_image = np.dstack([data[:,:,b] for b in rgb_bands])
+        rgb_image = np.dstack([data[:,:,b] for b in rgb_bands]).astype(np.float32, copy=False)
         
-        # Normalize RGB image for display
-        rgb_image = (rgb_image - rgb_image.min()) / (rgb_image.max() - rgb_image.min())
+        # Normalize RGB image for display, stretching each channel in place
+        # between its 2nd and 98th percentiles so hot pixels do not dominate
+        for i in range(3):
+            channel = rgb_image[:,:,i]
+            low, high = percentile_bounds(channel)
+            np.subtract(channel, low, out=channel)
+            channel *= 1.0 / (high - low) if high > low else 0.0
+            np.clip(channel, 0, 1, out=channel)
         
         return data, wavelengths, rgb_image, header
         
@@ -2,77 +2,112 @@ import numpy as np
 import pandas as pd
 from datetime import datetime
 import os
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+from envi_header import read_header
 
-def read_header(header_file):
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _apply_correction(chunk, correction_factor, scale, offset, fill, out):
+        """
+        Multiply a band chunk by its correction factor, clip to [0,1] and
+        scale to the output range in one pass; NaN pixels are set to fill
+        """
+        for i in prange(chunk.shape[0]):
+            for j in range(chunk.shape[1]):
+                v = chunk[i, j] * correction_factor
+                if np.isnan(v):
+                    out[i, j] = fill
+                    continue
+                if v < 0:
+                    v = 0.0
+                elif v > 1:
+                    v = 1.0
+                out[i, j] = v * scale + offset
+else:
+    _apply_correction = None
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# Fused correct, clip and scale expression for the numexpr path; NaN pixels
+# are set to the fill value
+CORRECTION_EXPR = 'where(x * c != x * c, f, where(x * c < 0, 0, where(x * c > 1, 1, x * c)) * s + o)'
+
+# ENVI data type codes for supported output types
+ENVI_DATA_TYPES = {
+    np.dtype(np.uint8): 1,
+    np.dtype(np.uint16): 12,
+    np.dtype(np.float32): 4,
+}
+
+def advise_sequential(memmap_array):
+    """Hint the kernel that a memory-mapped array will be streamed front to back"""
+    mm = getattr(memmap_array, '_mmap', None)
+    if mm is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+
+def write_header(header_file, nsamples, nlines, nbands, interleave, wavelengths, rad_header,
+                 dtype=np.float32):
     """
-    Read ENVI header file and parse all metadata
+    Write ENVI header for radiometrically corrected output
     
     Parameters:
     -----------
     header_file : str
         Path to header file
-        
-    Returns:
-    --------
-    dict : Header information including wavelengths and metadata
+    nsamples, nlines, nbands : int
+        Output dimensions
+    interleave : str
+        Interleave of the data file ('bsq' or 'bip')
+    wavelengths : list or None
+        Band center wavelengths
+    rad_header : dict
+        Radiance header to copy additional metadata from
+    dtype : numpy dtype
+        Data type of the data file; integer types store reflectance scaled
+        to the full range of the type
     """
-    header_info = {}
-    current_array = None
-    array_data = []
-    
-    with open(header_file, 'r') as f:
-        lines = f.readlines()
+    dtype = np.dtype(dtype)
+    with open(header_file, 'w') as f:
+        f.write("ENVI\n")
+        f.write("description = {Radiometrically corrected reflectance data}\n")
+        f.write(f"samples = {nsamples}\n")
+        f.write(f"lines = {nlines}\n")
+        f.write(f"bands = {nbands}\n")
+        f.write("header offset = 0\n")
+        f.write("file type = ENVI Standard\n")
+        f.write(f"data type = {ENVI_DATA_TYPES[dtype]}\n")
+        f.write(f"interleave = {interleave}\n")
+        f.write("byte order = 0\n")
+        if np.issubdtype(dtype, np.integer):
+            f.write(f"reflectance scale factor = {np.iinfo(dtype).max}\n")
         
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Handle array continuation
-            if current_array and '}' not in line:
-                array_data.extend([x.strip() for x in line.split(',')])
-                continue
-            elif current_array and '}' in line:
-                array_data.extend([x.strip() for x in line.split('}')[0].split(',')])
-                # Convert array data to floats
-                try:
-                    header_info[current_array] = [float(x) for x in array_data if x]
-                except ValueError:
-                    header_info[current_array] = array_data
-                current_array = None
-                array_data = []
-                continue
+        # Copy wavelength information
+        if wavelengths:
+            f.write("wavelength = {\n")
+            f.write(',\n'.join(np.char.mod(' %0.6f', np.asarray(wavelengths, dtype=np.float64))))
+            f.write("}\n")
+        
+        if 'wavelength units' in rad_header:
+            f.write(f"wavelength units = {rad_header['wavelength units']}\n")
             
-            if '=' in line:
-                key, value = [x.strip() for x in line.split('=', 1)]
-                key = key.lower()
-                
-                # Handle array start
-                if '{' in value and '}' not in value:
-                    current_array = key
-                    array_data = [x.strip() for x in value.split('{')[1].split(',')]
-                    continue
-                # Handle single line arrays
-                elif '{' in value and '}' in value:
-                    value = value.split('{')[1].split('}')[0].strip()
-                    if ',' in value:
-                        try:
-                            value = [float(x.strip()) for x in value.split(',') if x.strip()]
-                        except ValueError:
-                            value = [x.strip() for x in value.split(',') if x.strip()]
-                
-                # Convert numeric values
-                if key in ['samples', 'lines', 'bands', 'data type']:
-                    try:
-                        value = int(value)
-                    except ValueError:
-                        pass
-                
-                header_info[key] = value
-    
-    return header_info
+        # Copy additional metadata
+        if 'acquisition date' in rad_header:
+            f.write(f"acquisition date = {rad_header['acquisition date']}\n")
+        if 'sensor type' in rad_header:
+            f.write(f"sensor type = {rad_header['sensor type']}\n")
 
-def apply_enhanced_radiometric_correction(reflectance_files, radiance_files, chunk_size=500):
+def apply_enhanced_radiometric_correction(reflectance_files, radiance_files, chunk_size=500,
+                                          write_bip=True, max_band_bytes=256 * 1024**2,
+                                          output_dtype=np.uint16, max_workers=None):
     """
     Apply radiometric correction using both reflectance and original radiance data
     
@@ -83,7 +118,17 @@ def apply_enhanced_radiometric_correction(reflectance_files, radiance_files, chu
     radiance_files : dict
         Dictionary containing paths to original radiance files
     chunk_size : int
-        Size of chunks for processing large datasets
+        Number of lines per chunk for bands too large to process at once
+    write_bip : bool
+        Also write a BIP copy of the output for fast per-pixel spectrum access
+    max_band_bytes : int
+        Largest band size in bytes processed in a single pass
+    output_dtype : numpy dtype
+        Output data type; uint8/uint16 store reflectance scaled to the full
+        range of the type, float32 stores it unscaled
+    max_workers : int or None
+        Number of threads used by numexpr, or correcting bands concurrently
+        when neither numba nor numexpr is available (defaults to os.cpu_count())
     """
     print("Starting enhanced radiometric correction...")
     
@@ -113,8 +158,21 @@ def apply_enhanced_radiometric_correction(reflectance_files, radiance_files, chu
     output_file = reflectance_files['data'].replace('reflectance', 'radcorr')
     print(f"Creating output file: {output_file}")
     
+    # Integer outputs store reflectance quantized to the full range of the type
+    output_dtype = np.dtype(output_dtype)
+    if output_dtype not in ENVI_DATA_TYPES:
+        raise ValueError(f"Unsupported output data type: {output_dtype}")
+    if np.issubdtype(output_dtype, np.integer):
+        scale = float(np.iinfo(output_dtype).max)
+        offset = 0.5  # Round to nearest when the kernel truncates
+        fill = 0.0  # NaN has no integer representation, so nodata becomes 0
+    else:
+        scale = 1.0
+        offset = 0.0
+        fill = np.nan
+    
     # Create memory-mapped output file
-    output_data = np.memmap(output_file, dtype=np.float32, mode='w+',
+    output_data = np.memmap(output_file, dtype=output_dtype, mode='w+',
                            shape=(nbands, nlines, nsamples))
     
     # Get radiance scale factor from header
@@ -141,70 +199,100 @@ def apply_enhanced_radiometric_correction(reflectance_files, radiance_files, chu
                 except:
                     print("Warning: Could not parse radiance scale factor from header")
     
-    # Process data in chunks
-    print("Processing data in chunks...")
+    # Process whole bands, falling back to line chunks for very large bands
+    if nlines * nsamples * 4 <= max_band_bytes:
+        print("Processing data band by band...")
+        lines_per_chunk = nlines
+    else:
+        print("Processing data in chunks...")
+        lines_per_chunk = chunk_size
+        
     refl_data = np.memmap(reflectance_files['data'], dtype=np.float32, mode='r',
                          shape=(nbands, nlines, nsamples))
+    advise_sequential(refl_data)
+    advise_sequential(output_data)
+    
+    # Band-specific correction factors, wavelength-dependent where available
+    correction_factors = np.ones(nbands, dtype=np.float32)
+    if wavelengths:
+        nwave = min(len(wavelengths), nbands)
+        correction_factors[:nwave] = 1.0 + (np.asarray(wavelengths[:nwave], dtype=np.float32) - 500) / 1000.0
     
-    for band in range(nbands):
+    if _apply_correction is not None:
+        # Compile the kernel up front so the first band is not charged for it
+        # using views with the same layout and flags as the real chunks
+        _apply_correction(np.asarray(refl_data[0, :1, :]), correction_factors[0],
+                          scale, offset, fill, np.asarray(output_data[0, :1, :]))
+    
+    def correct_band(band):
         print(f"Processing band {band + 1}/{nbands}")
+        correction_factor = correction_factors[band]
         
-        # Calculate band-specific correction factor
-        if wavelengths and band < len(wavelengths):
-            # Wavelength-dependent correction factor
-            wavelength = wavelengths[band]
-            correction_factor = 1.0 + (wavelength - 500) / 1000.0
-        else:
-            correction_factor = 1.0
-        
-        for chunk_start in range(0, nlines, chunk_size):
-            chunk_end = min(chunk_start + chunk_size, nlines)
-            
-            # Read chunk
-            chunk = refl_data[band, chunk_start:chunk_end, :]
-            
-            # Apply radiometric correction
-            corrected_chunk = chunk * correction_factor
-            
-            # Clip values to valid range [0,1]
-            corrected_chunk = np.clip(corrected_chunk, 0, 1)
+        for chunk_start in range(0, nlines, lines_per_chunk):
+            chunk_end = min(chunk_start + lines_per_chunk, nlines)
             
-            # Save chunk
-            output_data[band, chunk_start:chunk_end, :] = corrected_chunk
-            
-            # Flush changes
-            output_data.flush()
+            # Apply radiometric correction and clip to valid range [0,1],
+            # writing straight into the output memmap
+            chunk = np.asarray(refl_data[band, chunk_start:chunk_end, :])
+            out = np.asarray(output_data[band, chunk_start:chunk_end, :])
+            if _apply_correction is not None:
+                _apply_correction(chunk, correction_factor, scale, offset, fill, out)
+                continue
+            if ne is not None:
+                ne.evaluate(CORRECTION_EXPR, out=out, casting='unsafe',
+                            local_dict={'x': chunk, 'c': correction_factor,
+                                        's': np.float32(scale), 'o': np.float32(offset),
+                                        'f': np.float32(fill)})
+                continue
+                
+            # Unit correction factor only needs the clip, not the multiply
+            if abs(correction_factor - 1.0) >= 1e-6:
+                chunk = chunk * correction_factor
+            if scale == 1.0:
+                np.clip(chunk, 0, 1, out=out)
+            else:
+                corrected = np.clip(chunk, 0, 1)
+                np.nan_to_num(corrected, copy=False, nan=fill)
+                corrected *= scale
+                np.rint(corrected, out=out, casting='unsafe')
+    
+    if _apply_correction is not None or ne is not None:
+        # The numba kernel and numexpr are already multi-threaded within a band
+        if _apply_correction is None:
+            ne.set_num_threads(max_workers or os.cpu_count())
+        for band in range(nbands):
+            correct_band(band)
+    else:
+        # NumPy releases the GIL, so independent bands are corrected concurrently;
+        # each BSQ band is a separate contiguous region of the output file
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            list(executor.map(correct_band, range(nbands)))
+    
+    # Flush changes once all bands are written
+    output_data.flush()
     
     # Create header file for output
     output_header = output_file + '.hdr'
     print(f"Saving header file: {output_header}")
+    write_header(output_header, nsamples, nlines, nbands, 'bsq', wavelengths, rad_header,
+                 output_dtype)
     
-    with open(output_header, 'w') as f:
-        f.write("ENVI\n")
-        f.write("description = {Radiometrically corrected reflectance data}\n")
-        f.write(f"samples = {nsamples}\n")
-        f.write(f"lines = {nlines}\n")
-        f.write(f"bands = {nbands}\n")
-        f.write("header offset = 0\n")
-        f.write("file type = ENVI Standard\n")
-        f.write("data type = 4\n")
-        f.write("interleave = bsq\n")
-        f.write("byte order = 0\n")
-        
-        # Copy wavelength information
-        if wavelengths:
-            f.write("wavelength = {\n")
-            f.write(',\n'.join(f" {w:0.6f}" for w in wavelengths))
-            f.write("}\n")
+    if write_bip:
+        # Write a pixel-interleaved copy so a single spectrum is one contiguous read
+        bip_file = os.path.splitext(output_file)[0] + '_bip.dat'
+        print(f"Creating BIP output file: {bip_file}")
+        bip_data = np.memmap(bip_file, dtype=output_dtype, mode='w+',
+                             shape=(nlines, nsamples, nbands))
+        advise_sequential(bip_data)
+        for chunk_start in range(0, nlines, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, nlines)
+            bip_data[chunk_start:chunk_end] = output_data[:, chunk_start:chunk_end, :].transpose(1, 2, 0)
+        bip_data.flush()
         
-        if 'wavelength units' in rad_header:
-            f.write(f"wavelength units = {rad_header['wavelength units']}\n")
-            
-        # Copy additional metadata
-        if 'acquisition date' in rad_header:
-            f.write(f"acquisition date = {rad_header['acquisition date']}\n")
-        if 'sensor type' in rad_header:
-            f.write(f"sensor type = {rad_header['sensor type']}\n")
+        bip_header = bip_file + '.hdr'
+        print(f"Saving header file: {bip_header}")
+        write_header(bip_header, nsamples, nlines, nbands, 'bip', wavelengths, rad_header,
+                     output_dtype)
     
     print("Radiometric correction completed successfully!")
     return output_file
@@ -5,6 +5,8 @@ from hyppy.plot import spectraplot, RGBplot
 import tkinter as tk
 from tkinter import ttk
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from display_utils import percentile_bounds, nearest_bands
+from envi_header import read_header
 
 class HyperspectralViewer:
     def __init__(self, root, data_file, header_file):
@@ -16,6 +18,16 @@ class HyperspectralViewer:
         self.data = self.envi_data.load()
         self.wavelengths = self.envi_data.waves
         
+        # Integer outputs of the radiometric correction store reflectance
+        # scaled by this factor
+        self.scale = float(read_header(header_file).get('reflectance scale factor', 1))
+        self._band_buf = None
+        
+        # Default RGB bands (approximate visible wavelengths); the composite is
+        # built on first display and reused when switching back to RGB
+        self.rgb_default = nearest_bands(self.wavelengths, [650, 550, 450])
+        self._rgb = None
+        
         # Create main frame
         self.main_frame = ttk.Frame(self.root)
         self.main_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -62,18 +74,12 @@ class HyperspectralViewer:
         self.fig.clear()
         ax = self.fig.add_subplot(111)
         
-        # Select bands for RGB (approximate visible wavelengths)
-        red_idx = np.argmin(np.abs(self.wavelengths - 650))
-        green_idx = np.argmin(np.abs(self.wavelengths - 550))
-        blue_idx = np.argmin(np.abs(self.wavelengths - 450))
-        
-        rgb = np.dstack([
-            self.normalize_band(self.data[:,:,red_idx]),
-            self.normalize_band(self.data[:,:,green_idx]),
-            self.normalize_band(self.data[:,:,blue_idx])
-        ])
+        if self._rgb is None:
+            self._rgb = np.empty(self.data.shape[:2] + (3,), dtype=np.float32)
+            for i, idx in enumerate(self.rgb_default):
+                self.normalize_band(self.data[:,:,idx], out=self._rgb[:,:,i])
         
-        ax.imshow(rgb)
+        ax.imshow(self._rgb)
         ax.set_title("RGB Composite")
         ax.axis('off')
         self.canvas.draw()
@@ -83,7 +89,9 @@ class HyperspectralViewer:
         ax = self.fig.add_subplot(111)
         
         band_idx = int(self.band_var.get()) - 1
-        band_data = self.normalize_band(self.data[:,:,band_idx])
+        if self._band_buf is None:
+            self._band_buf = np.empty(self.data.shape[:2], dtype=np.float32)
+        band_data = self.normalize_band(self.data[:,:,band_idx], out=self._band_buf)
         
         im = ax.imshow(band_data, cmap='viridis')
         ax.set_title(f"Band {band_idx + 1} ({self.wavelengths[band_idx]:.1f} nm)")
@@ -97,7 +105,7 @@ class HyperspectralViewer:
         
         # Get center pixel
         center_y, center_x = self.data.shape[0]//2, self.data.shape[1]//2
-        spectrum = self.data[center_y, center_x, :]
+        spectrum = self.data[center_y, center_x, :] / self.scale
         
         ax.plot(self.wavelengths, spectrum)
         ax.set_xlabel("Wavelength (nm)")
@@ -106,13 +114,18 @@ class HyperspectralViewer:
         ax.grid(True)
         self.canvas.draw()
         
-    def normalize_band(self, band):
+    def normalize_band(self, band, out=None):
         """Normalize band data to 0-1 range"""
-        min_val = np.percentile(band, 2)
-        max_val = np.percentile(band, 98)
+        if out is None:
+            out = np.empty(band.shape, dtype=np.float32)
+        min_val, max_val = percentile_bounds(band)
         if max_val == min_val:
-            return np.zeros_like(band)
-        return np.clip((band - min_val) / (max_val - min_val), 0, 1)
+            out[...] = 0
+            return out
+        np.subtract(band, min_val, out=out)
+        out /= (max_val - min_val)
+        np.clip(out, 0, 1, out=out)
+        return out
     
     def update_view(self, event=None):
         view = self.view_var.get()
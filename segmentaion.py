@@ -1,13 +1,104 @@
+import os
 import numpy as np
+import joblib
 from spectral import envi
-import sklearn.preprocessing as prep
-from sklearn.cluster import KMeans
+
+# Use Intel's accelerated scikit-learn kernels when scikit-learn-intelex is
+# installed; this must happen before sklearn estimators are imported
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    pass
+
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.decomposition import PCA
 import matplotlib.pyplot as plt
 
-def load_subset_hyperspectral(reflectance_file, header_file, subset_size=(500, 500)):
+# Large subsets are reduced and clustered on the GPU when RAPIDS cuML is
+# installed and a CUDA device is usable; without a working driver the imports
+# or the device query can fail with CUDA errors rather than ImportError
+try:
+    import cupy
+    from cuml.decomposition import PCA as cuPCA
+    from cuml.cluster import KMeans as cuKMeans
+    USE_GPU = cupy.cuda.runtime.getDeviceCount() > 0
+except Exception:
+    USE_GPU = False
+
+# Below this many pixels the transfer to the GPU outweighs the speedup
+GPU_MIN_ROWS = 100_000
+
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _cluster_sums(X, labels, n_clusters, n_blocks):
+        """Per-block cluster sums and counts in a single parallel pass over X"""
+        n, d = X.shape
+        sums = np.zeros((n_blocks, n_clusters, d))
+        counts = np.zeros((n_blocks, n_clusters), np.int64)
+        block = (n + n_blocks - 1) // n_blocks
+        for t in prange(n_blocks):
+            for i in range(t * block, min((t + 1) * block, n)):
+                c = labels[i]
+                counts[t, c] += 1
+                for j in range(d):
+                    sums[t, c, j] += X[i, j]
+        return sums, counts
+else:
+    _cluster_sums = None
+
+def iter_chunks(data, chunk_rows=256, interleave='bip'):
+    """
+    Yield successive row blocks of an image array in its source interleave
+    as C-contiguous (pixels, bands) arrays, reading only one block at a time
+    from a memmap. Each block is read in file order and transposed in memory
+    so bands end up as the fastest axis.
+    """
+    if interleave == 'bsq':
+        # (bands, rows, cols)
+        for start in range(0, data.shape[1], chunk_rows):
+            block = np.array(data[:, start:start+chunk_rows, :])
+            yield np.ascontiguousarray(block.transpose(1, 2, 0)).reshape(-1, data.shape[0])
+    elif interleave == 'bil':
+        # (rows, bands, cols)
+        for start in range(0, data.shape[0], chunk_rows):
+            block = np.array(data[start:start+chunk_rows])
+            yield np.ascontiguousarray(block.transpose(0, 2, 1)).reshape(-1, data.shape[1])
+    else:
+        # (rows, cols, bands)
+        for start in range(0, data.shape[0], chunk_rows):
+            yield np.ascontiguousarray(data[start:start+chunk_rows]).reshape(-1, data.shape[2])
+
+def update_stats(count, mean, m2, chunk):
+    """
+    Merge the per-band mean and sum of squared deviations of a chunk into
+    running totals (Welford/Chan parallel update). Pass m2=None to track the
+    mean only.
+    """
+    n = chunk.shape[0]
+    if n == 0:
+        return count, mean, m2
+    chunk_mean = chunk.mean(axis=0, dtype=np.float64)
+    total = count + n
+    delta = chunk_mean - mean
+    mean = mean + delta * (n / total)
+    if m2 is not None:
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        m2 = m2 + chunk_m2 + delta ** 2 * (count * n / total)
+    return total, mean, m2
+
+def load_subset_hyperspectral(reflectance_file, header_file, subset_size=(500, 500),
+                              chunk_rows=256, standardize=False):
     """
     Load a subset of hyperspectral data from ENVI format files
+
+    Valid pixels are mean-centred per band; with standardize=True they are
+    also scaled to unit variance.
     """
     try:
         # Load the hyperspectral data header first
@@ -26,24 +117,47 @@ def load_subset_hyperspectral(reflectance_file, header_file, subset_size=(500, 5
         
         print(f"Loading subset of size {subset_rows}x{subset_cols} from {rows}x{cols} image...")
         
-        # Load only the subset using memmap
-        data = img.open_memmap()
-        subset = data[start_row:start_row+subset_rows, 
-                     start_col:start_col+subset_cols, :]
+        # Keep the subset as a memmap view in the file's own interleave; it is
+        # read in row chunks below
+        interleave = str(img.metadata.get('interleave', 'bip')).lower()
+        data = img.open_memmap(interleave='source')
+        rows_slice = slice(start_row, start_row+subset_rows)
+        cols_slice = slice(start_col, start_col+subset_cols)
+        if interleave == 'bsq':
+            subset = data[:, rows_slice, cols_slice]
+        elif interleave == 'bil':
+            subset = data[rows_slice, :, cols_slice]
+        else:
+            subset = data[rows_slice, cols_slice, :]
         
-        # Convert to numpy array in memory
-        subset = np.array(subset)
+        # First pass: stream the subset as (pixels x bands) chunks, finding
+        # valid pixels (no zeros or negatives) and accumulating band statistics
+        count, mean = 0, np.zeros(bands)
+        m2 = np.zeros(bands) if standardize else None
+        valid_chunks = []
+        for chunk in iter_chunks(subset, chunk_rows, interleave):
+            valid = chunk.min(axis=1) > 0
+            count, mean, m2 = update_stats(count, mean, m2,
+                                           chunk[valid].astype(np.float32, copy=False))
+            valid_chunks.append(valid)
+        valid_pixels = np.concatenate(valid_chunks)
         
-        # Reshape to 2D array (pixels x bands)
-        pixels = subset_rows * subset_cols
-        X = subset.reshape(pixels, bands)
+        mean = mean.astype(np.float32)
+        if standardize:
+            std = np.sqrt(m2 / max(count, 1))
+            std[std == 0] = 1
+            inv_std = (1.0 / std).astype(np.float32)
         
-        # Remove invalid pixels (zeros or negatives)
-        valid_pixels = np.all(X > 0, axis=1)
-        X = X[valid_pixels]
-        
-        # Apply normalization
-        X = prep.StandardScaler().fit_transform(X)
+        # Second pass: centre (and optionally scale) valid pixels straight
+        # into a preallocated float32 buffer
+        X = np.empty((count, bands), dtype=np.float32)
+        pos = 0
+        for chunk, valid in zip(iter_chunks(subset, chunk_rows, interleave), valid_chunks):
+            block = X[pos:pos + np.count_nonzero(valid)]
+            np.subtract(chunk[valid], mean, out=block, dtype=np.float32)
+            if standardize:
+                block *= inv_std
+            pos += len(block)
         
         return X, (subset_rows, subset_cols), valid_pixels
         
@@ -51,12 +165,28 @@ def load_subset_hyperspectral(reflectance_file, header_file, subset_size=(500, 5
         print(f"Error loading data: {str(e)}")
         raise
 
-def perform_clustering(X, n_clusters=4):
+def perform_clustering(X, n_clusters=4, batch_size=None):
     """
     Perform clustering to segment different seafloor classes
+
+    batch_size only applies to MiniBatchKMeans; subsets clustered with cuML
+    on the GPU run full-batch k-means and ignore it.
     """
     try:
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+        if USE_GPU and X.shape[0] > GPU_MIN_ROWS:
+            kmeans = cuKMeans(n_clusters=n_clusters, init='k-means++', n_init=1,
+                              max_iter=100, tol=1e-3, random_state=42,
+                              output_type='numpy')
+            labels = cupy.asnumpy(kmeans.fit_predict(cupy.asarray(X)))
+            return labels, kmeans
+        
+        # Batches larger than 256 * cores let sklearn parallelise each step
+        if batch_size is None:
+            batch_size = max(1024, 256 * (os.cpu_count() or 1))
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size,
+                                 init='k-means++', n_init=1, max_iter=100,
+                                 tol=1e-3, random_state=42,
+                                 reassignment_ratio=0.01)
         labels = kmeans.fit_predict(X)
         return labels, kmeans
     except Exception as e:
@@ -68,8 +198,14 @@ def reduce_dimensions(X, n_components=10):
     Reduce dimensionality using PCA
     """
     try:
-        pca = PCA(n_components=n_components)
-        X_reduced = pca.fit_transform(X)
+        if USE_GPU and X.shape[0] > GPU_MIN_ROWS:
+            pca = cuPCA(n_components=n_components, output_type='numpy')
+            X_reduced = cupy.asnumpy(pca.fit_transform(cupy.asarray(X)))
+        else:
+            # Randomized SVD only computes the leading components
+            pca = PCA(n_components=n_components, svd_solver='randomized',
+                      iterated_power=4, random_state=42)
+            X_reduced = pca.fit_transform(X)
         explained_var = np.sum(pca.explained_variance_ratio_)
         print(f"Explained variance with {n_components} components: {explained_var:.2%}")
         return X_reduced, pca
@@ -77,6 +213,30 @@ def reduce_dimensions(X, n_components=10):
         print(f"Error in dimension reduction: {str(e)}")
         raise
 
+def compute_cluster_means(X, labels, n_clusters):
+    """
+    Calculate the mean spectrum of each cluster
+    """
+    try:
+        if _cluster_sums is not None:
+            # Each thread accumulates its own block of rows, then blocks are summed
+            sums, counts = _cluster_sums(X, labels.astype(np.int64), n_clusters,
+                                         get_num_threads())
+            with np.errstate(invalid='ignore'):
+                return sums.sum(axis=0) / counts.sum(axis=0)[:, None]
+        
+        # One bincount per band sums every cluster in a single pass over the
+        # column, instead of copying out X[labels == i] for each cluster
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.empty((n_clusters, X.shape[1]))
+        for j in range(X.shape[1]):
+            sums[:, j] = np.bincount(labels, weights=X[:, j], minlength=n_clusters)
+        with np.errstate(invalid='ignore'):
+            return sums / counts[:, None]
+    except Exception as e:
+        print(f"Error calculating cluster means: {str(e)}")
+        raise
+
 def reconstruct_image(labels, image_shape, valid_pixels):
     """
     Reconstruct the segmentation map to original image dimensions
@@ -107,36 +267,85 @@ def save_results(segmentation_map, cluster_means, output_prefix="test_subset"):
         print(f"Error saving results: {str(e)}")
         raise
 
-def main(reflectance_file, header_file, subset_size=(500, 500), n_clusters=4):
+def load_models(model_file, key):
+    """
+    Load the PCA and clustering models saved by an earlier run, or
+    (None, None) if none were saved or they were fitted for a different key
+    """
+    if not os.path.exists(model_file):
+        return None, None
+    try:
+        saved = joblib.load(model_file)
+    except Exception as e:
+        print(f"Warning: Could not load models {model_file}: {str(e)}")
+        return None, None
+    if not isinstance(saved, dict) or saved.get('key') != key:
+        return None, None
+    return saved['pca'], saved['kmeans']
+
+def save_models(model_file, key, pca, kmeans):
+    """
+    Save fitted PCA and clustering models with the key they were fitted for
+    """
+    try:
+        joblib.dump({'key': key, 'pca': pca, 'kmeans': kmeans}, model_file, compress=3)
+    except Exception as e:
+        print(f"Warning: Could not save models {model_file}: {str(e)}")
+
+def main(reflectance_file, header_file, subset_size=(500, 500), n_clusters=4,
+         batch_size=None, exact_means=False, output_prefix="test_subset",
+         reuse_models=True, standardize=False):
     try:
         # Load and preprocess subset of data
         print("Loading subset of hyperspectral data...")
         X, image_shape, valid_pixels = load_subset_hyperspectral(
             reflectance_file, 
             header_file, 
-            subset_size
+            subset_size,
+            standardize=standardize
         )
         
         print(f"Loaded data shape: {X.shape}")
         
-        # Reduce dimensions
-        print("Reducing dimensions...")
-        X_reduced, pca = reduce_dimensions(X)
+        # Models fitted on an earlier run are only reused if they were fitted
+        # on the same files, subset, settings and backend
+        model_file = f"{output_prefix}_models.pkl.gz"
+        model_key = {
+            'reflectance_file': os.path.abspath(reflectance_file),
+            'mtime': os.path.getmtime(reflectance_file),
+            'header_file': os.path.abspath(header_file),
+            'header_mtime': os.path.getmtime(header_file),
+            'subset_size': tuple(subset_size),
+            'n_clusters': n_clusters,
+            'batch_size': batch_size,
+            'standardize': standardize,
+            'gpu': USE_GPU and X.shape[0] > GPU_MIN_ROWS,
+        }
+        pca, kmeans = load_models(model_file, model_key) if reuse_models else (None, None)
         
-        # Perform clustering
-        print("Clustering pixels...")
-        labels, kmeans = perform_clustering(X_reduced, n_clusters)
+        if pca is not None:
+            print(f"Reusing PCA and clustering from {model_file}")
+            X_reduced = pca.transform(X)
+            labels = kmeans.predict(X_reduced)
+        else:
+            # Reduce dimensions
+            print("Reducing dimensions...")
+            X_reduced, pca = reduce_dimensions(X)
+            
+            # Perform clustering
+            print("Clustering pixels...")
+            labels, kmeans = perform_clustering(X_reduced, n_clusters, batch_size)
+            save_models(model_file, model_key, pca, kmeans)
         
         # Reconstruct segmentation map
         segmentation_map = reconstruct_image(labels, image_shape, valid_pixels)
         
-        # Calculate mean spectra for each cluster
-        cluster_means = []
-        for i in range(n_clusters):
-            cluster_pixels = X[labels == i]
-            mean_spectrum = np.mean(cluster_pixels, axis=0)
-            cluster_means.append(mean_spectrum)
-        cluster_means = np.array(cluster_means)
+        # Calculate mean spectra for each cluster; by default map the cluster
+        # centers back from PCA space rather than rescanning X
+        if exact_means:
+            cluster_means = compute_cluster_means(X, labels, n_clusters)
+        else:
+            cluster_means = pca.inverse_transform(kmeans.cluster_centers_)
         
         # Plot results
         plt.figure(figsize=(12, 5))
@@ -159,7 +368,7 @@ def main(reflectance_file, header_file, subset_size=(500, 500), n_clusters=4):
         plt.tight_layout()
         
         # Save results
-        save_results(segmentation_map, cluster_means)
+        save_results(segmentation_map, cluster_means, output_prefix)
         
         return segmentation_map, cluster_means, labels, kmeans
         
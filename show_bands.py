@@ -1,18 +1,61 @@
+import os
+import zipfile
 import spectral
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button
 from matplotlib.colors import Normalize
 
 class HyperspectralViewer:
+    # Cubes up to this size are copied into memory for spectrum lookups
+    MAX_CUBE_BYTES = 2 * 1024**3
+    
+    # Memory budget for normalized bands, and separately for raw bands read ahead
+    BAND_CACHE_BYTES = MAX_CUBE_BYTES // 4
+    
+    # Number of bands either side of the current band read ahead in the background
+    PREFETCH_DISTANCE = 3
+    
+    # Size of the row blocks read while computing band statistics
+    STATS_BLOCK_BYTES = 32 * 1024**2
+    
     def __init__(self, data_file, header_file):
         # Load the data
+        self.data_file = data_file
         self.img = spectral.envi.open(header_file, data_file)
+        
+        # Band reads run on a thread pool through a memmap, so neighbouring
+        # bands can be prefetched while the slider moves. Raw bands are only
+        # held until they are normalized; normalized bands stay cached so
+        # revisiting a band does not go back to disk
+        self._cube = self.img.open_memmap()
+        self._executor = ThreadPoolExecutor(max_workers=4)
+        self._band_futures = OrderedDict()
+        self._normalized = OrderedDict()
+        self._pixel_cube = None
+        
+        # Size the caches from the band size so large images stay in budget
+        rows, cols, _ = self._cube.shape
+        self._cache_size = max(1, self.BAND_CACHE_BYTES // (rows * cols * 4))
+        raw_band_bytes = rows * cols * self._cube.itemsize
+        self._prefetch_distance = min(self.PREFETCH_DISTANCE,
+                                      self.BAND_CACHE_BYTES // raw_band_bytes // 2)
+        
+        # Per-band stretch limits are constant for a cube, so they are
+        # computed once and kept in a sidecar file for later launches
+        self._vmin, self._vmax = self._precompute_band_stats()
         self.current_band = 0
         self.rgb_bands = [46, 28, 9]  # Approximately R:650nm, G:550nm, B:450nm
         
+        # The RGB composite does not depend on the band slider, so build it once
+        self._rgb = self.create_rgb()
+        self._rgb_key = tuple(self.rgb_bands)
+        
         # Create the main figure
         self.fig = plt.figure(figsize=(15, 8))
+        self.fig.canvas.mpl_connect('close_event', self.on_close)
         self.setup_layout()
         
     def setup_layout(self):
@@ -46,36 +89,182 @@ class HyperspectralViewer:
         
     def update_band(self, val):
         self.current_band = int(val)
+        self.prefetch(self.current_band)
         self.update_display()
         
-    def normalize_band(self, band_data):
-        """Normalize band data to 0-1 range"""
-        valid_data = band_data[~np.isnan(band_data)]
-        vmin, vmax = np.percentile(valid_data, (2, 98))
-        normalized = np.clip((band_data - vmin) / (vmax - vmin), 0, 1)
+    def _read_band(self, band):
+        """Copy a single band out of the memmap"""
+        return np.array(self._cube[:, :, band])
+        
+    def _submit_read(self, band):
+        """Start reading a band unless it is already in flight"""
+        future = self._band_futures.get(band)
+        if future is None:
+            future = self._executor.submit(self._read_band, band)
+            self._band_futures[band] = future
+            if len(self._band_futures) > 2 * self._prefetch_distance + 1:
+                self._band_futures.popitem(last=False)[1].cancel()
+        else:
+            self._band_futures.move_to_end(band)
+        return future
+        
+    def read_band(self, band):
+        """Return a band, waiting on its prefetch if one is in flight"""
+        future = self._submit_read(band)
+        
+        # Callers normalize the band straight away, so the raw copy is not kept
+        del self._band_futures[band]
+        return future.result()
+        
+    def prefetch(self, band):
+        """Read the bands around band in the background"""
+        for offset in range(1, self._prefetch_distance + 1):
+            for b in (band + offset, band - offset):
+                if 0 <= b < self.img.nbands and b not in self._normalized:
+                    self._submit_read(b)
+        
+    def on_close(self, event):
+        """Stop background reads when the figure is closed"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        
+    def _row_blocks(self):
+        """Yield the cube as (pixels x bands) blocks of whole rows"""
+        rows, cols, nbands = self._cube.shape
+        block_rows = max(1, self.STATS_BLOCK_BYTES // (cols * nbands * self._cube.itemsize))
+        for r in range(0, rows, block_rows):
+            yield np.asarray(self._cube[r:r + block_rows]).reshape(-1, nbands)
+        
+    def _compute_band_stats(self, bins=1024):
+        """
+        Approximate the 2nd and 98th percentiles of every band from 1024-bin
+        histograms, reading the cube in row blocks rather than once per band
+        """
+        nbands = self.img.nbands
+        
+        # First pass: per-band range, ignoring NaNs
+        lo = np.full(nbands, np.inf)
+        hi = np.full(nbands, -np.inf)
+        for block in self._row_blocks():
+            lo = np.fmin(lo, np.fmin.reduce(block, axis=0))
+            hi = np.fmax(hi, np.fmax.reduce(block, axis=0))
+        empty = ~np.isfinite(lo)
+        lo[empty] = hi[empty] = 0
+        width = hi - lo
+        scale = np.divide(bins, width, out=np.zeros(nbands), where=width > 0)
+        
+        # Second pass: histogram every band at once, offsetting each band's
+        # bin indices so a single bincount fills all of them
+        offsets = np.arange(nbands) * bins
+        hist = np.zeros(nbands * bins, dtype=np.int64)
+        lo32, scale32 = lo.astype(np.float32), scale.astype(np.float32)
+        for block in self._row_blocks():
+            idx = (block - lo32) * scale32
+            
+            # Only NaN pixels are skipped; rounding lo to float32 can put the
+            # minimum just below zero, so clamp into range rather than drop
+            valid = ~np.isnan(idx)
+            np.clip(idx, 0, bins - 1, out=idx)
+            np.nan_to_num(idx, copy=False)
+            hist += np.bincount((idx.astype(np.intp) + offsets)[valid],
+                                minlength=nbands * bins)
+        
+        cdf = np.cumsum(hist.reshape(nbands, bins), axis=1)
+        total = cdf[:, -1:]
+        k_low = (cdf < 0.02 * total).sum(axis=1)
+        k_high = (cdf < 0.98 * total).sum(axis=1)
+        step = width / bins
+        return lo + k_low * step, lo + k_high * step
+        
+    def _precompute_band_stats(self):
+        """Load per-band 2nd/98th percentiles from the stats sidecar, computing them if missing or stale"""
+        stats_file = f"{self.data_file}.stats.npz"
+        mtime = os.path.getmtime(self.data_file)
+        try:
+            with np.load(stats_file) as stats:
+                if stats['mtime'] == mtime and len(stats['vmin']) == self.img.nbands:
+                    return stats['vmin'], stats['vmax']
+        except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+            pass
+        
+        print(f"Computing band statistics for {self.data_file}...")
+        vmin, vmax = self._compute_band_stats()
+        
+        # Write to a temporary file first so an interrupted run cannot leave
+        # a truncated sidecar behind
+        tmp_file = stats_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, vmin=vmin, vmax=vmax, mtime=mtime)
+            os.replace(tmp_file, stats_file)
+        except OSError:
+            print(f"Warning: Could not write band statistics {stats_file}")
+        return vmin, vmax
+        
+    def normalize_band(self, band_data, band, out=None):
+        """Normalize band data to 0-1 range using the precomputed limits of band"""
+        vmin, vmax = self._vmin[band], self._vmax[band]
+        if out is None:
+            out = np.empty(band_data.shape, dtype=np.float32)
+        if vmax == vmin:
+            out[...] = 0
+            return out
+        np.subtract(band_data, vmin, out=out, dtype=np.float32)
+        out /= (vmax - vmin)
+        np.clip(out, 0, 1, out=out)
+        return out
+        
+    def get_normalized_band(self, band):
+        """Return a normalized band, keeping recently used bands cached"""
+        normalized = self._normalized.get(band)
+        if normalized is None:
+            normalized = self.normalize_band(self.read_band(band), band)
+            self._normalized[band] = normalized
+            if len(self._normalized) > self._cache_size:
+                self._normalized.popitem(last=False)
+        else:
+            self._normalized.move_to_end(band)
         return normalized
         
     def create_rgb(self):
         """Create RGB composite from three bands"""
-        rgb = np.dstack([
-            self.normalize_band(self.img.read_band(b))
-            for b in self.rgb_bands
-        ])
+        rows, cols = self.img.shape[:2]
+        rgb = np.empty((rows, cols, 3), dtype=np.float32)
+        for i, b in enumerate(self.rgb_bands):
+            self.normalize_band(self.read_band(b), b, out=rgb[..., i])
         return rgb
         
+    def get_rgb(self):
+        """Return the cached RGB composite, rebuilding it if rgb_bands changed"""
+        if tuple(self.rgb_bands) != self._rgb_key:
+            self._rgb = self.create_rgb()
+            self._rgb_key = tuple(self.rgb_bands)
+        return self._rgb
+        
+    def get_spectrum(self, y, x):
+        """
+        Return the spectrum at (y, x), from an in-memory copy of the cube if it
+        fits, divided by the header's reflectance scale factor like read_pixel
+        """
+        if self._pixel_cube is None:
+            if self._cube.nbytes <= self.MAX_CUBE_BYTES:
+                # Copying the (rows, cols, bands) view gives a BIP array, so each
+                # spectrum is contiguous whatever the file interleave
+                self._pixel_cube = np.ascontiguousarray(self._cube)
+            else:
+                self._pixel_cube = self._cube
+        return self._pixel_cube[y, x, :] / float(self.img.scale_factor)
+        
     def update_display(self):
         # Clear previous plots
         self.ax_band.clear()
         self.ax_rgb.clear()
         
         # Display single band
-        band_data = self.img.read_band(self.current_band)
-        self.ax_band.imshow(self.normalize_band(band_data), cmap='viridis')
+        self.ax_band.imshow(self.get_normalized_band(self.current_band), cmap='viridis')
         self.ax_band.set_title(f'Band {self.current_band + 1} - {self.img.bands.centers[self.current_band]:.2f}nm')
         
         # Display RGB composite
-        rgb = self.create_rgb()
-        self.ax_rgb.imshow(rgb)
+        self.ax_rgb.imshow(self.get_rgb())
         self.ax_rgb.set_title('RGB Composite\nR:650nm, G:550nm, B:450nm')
         
         # Remove axes for image displays
@@ -92,7 +281,7 @@ class HyperspectralViewer:
                 self.ax_spec.clear()
                 
                 # Get spectral profile
-                spectrum = self.img.read_pixel(y, x)
+                spectrum = self.get_spectrum(y, x)
                 wavelengths = self.img.bands.centers
                 
                 # Plot spectrum